@@ -0,0 +1,36 @@
+"""Compact probabilistic set membership for large id sets."""
+import hashlib
+import math
+import os
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter. Membership tests never give false negatives, but give false
+    positives at roughly `error_rate` once `capacity` items have been added.
+    Every filter is salted differently, so repeated runs report different false positives.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(capacity, 1)
+        self.num_bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.salt = os.urandom(hashlib.blake2b.SALT_SIZE)
+
+    def _positions(self, item):
+        # An independent 64-bit hash per position. Double hashing (h1 + i * h2) collapses all
+        # positions onto a few bits whenever h2 shares a factor with a small num_bits.
+        digest = hashlib.shake_128(self.salt + str(item).encode()).digest(8 * self.num_hashes)
+        return (int.from_bytes(digest[i:i + 8], 'little') % self.num_bits for i in range(0, len(digest), 8))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
@@ -1,11 +1,50 @@
 """Generic Client for interacting with data sources."""
+import base64
+import csv
 import datetime
+import decimal
+import functools
+import io
 import logging
-from sqlalchemy import MetaData, Table
-from typing import Dict, Set, List
+import math
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import chain, islice
+from operator import itemgetter
+import numpy
+from sqlalchemy import Column, MetaData, Table, func, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import bindparam, text
+from sqlalchemy.util import LRUCache
+from typing import Dict, Set, List, Tuple
+from elt_tools.bloom import BloomFilter
 from elt_tools.engines import engine_from_settings
 from elt_tools.settings import ELT_PAIRS, DATABASES
 
+# SQL expression for the wall clock seconds from {start} to a timestamp {field}, by dialect.
+# Both sides are read in the session time zone, like the bounds of the WHERE clause.
+SECONDS_SINCE_SQL = {
+    'bigquery': 'DATETIME_DIFF(CAST({field} AS DATETIME), CAST({start} AS DATETIME), SECOND)',
+    'postgresql': 'EXTRACT(EPOCH FROM CAST({field} AS TIMESTAMP) - CAST({start} AS TIMESTAMP))',
+    'redshift': 'DATEDIFF(second, CAST({start} AS TIMESTAMP), CAST({field} AS TIMESTAMP))',
+    'mysql': 'TIMESTAMPDIFF(SECOND, {start}, {field})',
+    'sqlite': "STRFTIME('%s', {field}) - STRFTIME('%s', {start})",
+}
+
+# Rows per INSERT statement for engines without a native bulk loader.
+INSERT_BATCH_SIZE = 1000
+
+# Ids per DELETE statement on BigQuery, whose requests are limited in size.
+BIGQUERY_DELETE_BATCH_SIZE = 10000
+
+# Values whose str() Postgres reads back as the same value from CSV.
+COPY_SCALAR_TYPES = (str, int, float, decimal.Decimal, datetime.date, datetime.time, datetime.timedelta, uuid.UUID)
+
+# Reuse the same statement object for the same query text, so that
+# SQLAlchemy's compiled cache can recognise it.
+_cached_text = functools.lru_cache(maxsize=1024)(text)
+
 
 def _construct_where_clause_from_timerange(
         start_datetime: datetime.datetime = None,
@@ -13,7 +52,12 @@ def _construct_where_clause_from_timerange(
         timestamp_fields: List[str] = None,
         stick_to_dates: bool = False
 ):
-    where_clause = ""
+    """
+    Build a WHERE clause restricting timestamp_fields to the given range.
+    The range is passed as named bind parameters so that the query text stays the same
+    for every range. Returns the clause together with its parameters.
+    """
+    params = {}
 
     if stick_to_dates and start_datetime == end_datetime:
         msg = "The date range for dates is inclusive of the start date and exclusive of the end date." \
@@ -31,26 +75,196 @@ def _construct_where_clause_from_timerange(
         if end_datetime:
             end_datetime = end_datetime.date()
 
-    if timestamp_fields and start_datetime and end_datetime:
+    # Bind as strings, so they coerce to the column type like the literals they replace.
+    if start_datetime:
+        params['start_datetime'] = str(start_datetime)
+    if end_datetime:
+        params['end_datetime'] = str(end_datetime)
+
+    where_clause = _where_clause_template(
+        tuple(timestamp_fields or ()),
+        bool(start_datetime),
+        bool(end_datetime),
+    )
+    return where_clause, params
+
+
+@functools.lru_cache(maxsize=1024)
+def _where_clause_template(timestamp_fields: tuple, has_start: bool, has_end: bool) -> str:
+    """The query text only depends on which range bounds are set, so build it once per shape."""
+    where_clause = ""
+
+    if timestamp_fields and has_start and has_end:
         where_clause += " WHERE " + " OR ".join([
-            f"({timestamp_field} >= '{start_datetime}' AND {timestamp_field} < '{end_datetime}')"
+            f"({timestamp_field} >= :start_datetime AND {timestamp_field} < :end_datetime)"
             for timestamp_field in timestamp_fields
         ])
         return where_clause
 
-    if timestamp_fields and start_datetime:
+    if timestamp_fields and has_start:
         where_clause += " WHERE " + " AND ".join([
-            f"{timestamp_field} >= '{start_datetime}'"
+            f"{timestamp_field} >= :start_datetime"
             for timestamp_field in timestamp_fields
         ])
-    if timestamp_fields and end_datetime:
+    if timestamp_fields and has_end:
         where_clause += " AND " + " AND ".join([
-            f"{timestamp_field} < '{end_datetime}'"
+            f"{timestamp_field} < :end_datetime"
             for timestamp_field in timestamp_fields
         ])
     return where_clause
 
 
+@functools.lru_cache(maxsize=1024)
+def _count_query(table_name, field_name, where_clause):
+    return f"""
+        SELECT COUNT({field_name}) FROM {table_name}
+        """ + where_clause
+
+
+@functools.lru_cache(maxsize=1024)
+def _ids_query(table_name, key_field, timestamp_fields: tuple, has_start: bool, has_end: bool, union: str):
+    """
+    With a time range on several timestamp fields, select the keys for each field separately
+    and UNION them, rather than OR-ing the ranges in one WHERE clause. Each branch can then
+    use an index (or clustering) on its own timestamp field, so have one on each of them.
+    """
+    if len(timestamp_fields) > 1 and has_start and has_end:
+        return f" {union} ".join(
+            _ids_query(table_name, key_field, (timestamp_field,), has_start, has_end, union)
+            for timestamp_field in timestamp_fields
+        )
+    return f"""
+            SELECT {key_field} AS id FROM {table_name}
+        """ + _where_clause_template(timestamp_fields, has_start, has_end)
+
+
+@functools.lru_cache(maxsize=1024)
+def _ids_by_day_query(table_name, key_field, timestamp_fields: tuple):
+    """Select the keys in the time range along with the day of each of their timestamp fields,
+    one row per field."""
+    return " UNION ALL ".join(
+        f"""
+            SELECT {key_field} AS id, DATE({timestamp_field}) AS day FROM {table_name}
+        """ + _where_clause_template((timestamp_field,), True, True)
+        for timestamp_field in timestamp_fields
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def _existing_ids_query(table_name, key_field):
+    return text(f"""
+        SELECT {key_field} AS id FROM {table_name} WHERE {key_field} IN :ids
+        """).bindparams(bindparam('ids', expanding=True))
+
+
+def _delete_ids_query(dialect, table_name, key_field, key_type) -> str:
+    """DELETE statement for the keys in the array parameter `ids`, on Postgres or BigQuery."""
+    if dialect.name == 'postgresql':
+        # cast, since string ids (e.g. UUIDs) are sent as a text array
+        condition = f"= ANY(CAST(:ids AS {key_type.compile(dialect=dialect)}[]))"
+    else:
+        condition = "IN UNNEST(:ids)"
+    return f"""
+            DELETE FROM {table_name}
+            WHERE {key_field} {condition}
+            """
+
+
+def _days_in_range(start_datetime, end_datetime):
+    """Yield the dates overlapping the range from start_datetime up to (excluding) end_datetime."""
+    if not isinstance(end_datetime, datetime.datetime):
+        end_datetime = datetime.datetime.combine(end_datetime, datetime.time())
+    day = start_datetime.date() if isinstance(start_datetime, datetime.datetime) else start_datetime
+    while datetime.datetime.combine(day, datetime.time(), tzinfo=end_datetime.tzinfo) < end_datetime:
+        yield day
+        day += datetime.timedelta(days=1)
+
+
+def _as_date(value) -> datetime.date:
+    """Dates come back as date objects or, e.g. from sqlite, as ISO strings."""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value)[:10])
+
+
+def _is_copy_scalar(value) -> bool:
+    """Whether value can be written to COPY's CSV as str(value). The string '\\N' can't,
+    since it stands for NULL there."""
+    return value is None or (isinstance(value, COPY_SCALAR_TYPES) and value != '\\N')
+
+
+def _json_value(value):
+    """Render value the way BigQuery reads it from JSON: records and repeated fields as they are,
+    bytes base64 encoded, dates and times in ISO format."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        return {k: _json_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_value(v) for v in value]
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode('ascii')
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def _iter_ids(rows):
+    """Yield the `id` column of rows, cast to str unless it is an int (e.g. UUIDs).
+    All ids of a column share a type, so the cast is chosen once from the first row
+    rather than checked on every row."""
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return
+    ids = map(itemgetter('id'), chain([first], rows))
+    if isinstance(first['id'], int):
+        yield from ids
+    else:
+        yield from map(str, ids)
+
+
+def _collect_ids(rows, batch_size=100000):
+    """Collect the ids of rows into an int64 numpy array if they are integers, otherwise into a set.
+    An array takes a fraction of the memory of a set of Python ints. Integers beyond int64
+    (e.g. MySQL's BIGINT UNSIGNED) end up in a set as well."""
+    ids = _iter_ids(rows)
+    first = next(ids, None)
+    if not isinstance(first, int):
+        return set() if first is None else set(chain([first], ids))
+    arrays = []
+    for batch in _chunked(chain([first], ids), batch_size):
+        try:
+            arrays.append(numpy.array(batch, dtype=numpy.int64))
+        except OverflowError:
+            return set(chain.from_iterable(array.tolist() for array in arrays)).union(batch, ids)
+    return numpy.concatenate(arrays)
+
+
+def _iter_result(result, size=50000):
+    """Yield the rows of a query result, fetching `size` rows at a time, then close it."""
+    try:
+        while True:
+            rows = result.fetchmany(size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        result.close()
+
+
+def _chunked(iterable, size):
+    """Yield successive lists of at most `size` items from `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class DataClient:
     # Override this if you want
     # to pass in your settings.
@@ -60,6 +274,9 @@ class DataClient:
         self.engine = engine
         self.metadata = MetaData(bind=self.engine)
         self.table_name = None
+        self._table_cache = {}
+        self._table_cache_lock = threading.Lock()
+        self._compiled_cache = LRUCache(1024)
 
     @classmethod
     def from_settings(cls, db_key, databases: Dict = None):
@@ -72,24 +289,115 @@ class DataClient:
     @property
     def table(self):
         if self.table_name:
-            return Table(self.table_name, self.metadata, autoload=True)
+            return self.get_table(self.table_name)
         return None
 
+    def get_table(self, table_name):
+        """Reflect a table, only querying the database the first time it is asked for."""
+        # Locked, since threads reflecting the same table into one MetaData see it half-built.
+        with self._table_cache_lock:
+            if table_name not in self._table_cache:
+                self._table_cache[table_name] = Table(table_name, self.metadata, autoload=True)
+            return self._table_cache[table_name]
+
+    def invalidate_table(self, table_name):
+        """Forget the reflected table, e.g. after its schema was changed."""
+        with self._table_cache_lock:
+            table = self._table_cache.pop(table_name, None)
+            if table is not None:
+                self.metadata.remove(table)
+
     def insert_rows(self, rows, table=None, replace=None):
-        """Insert rows into table."""
-        if replace:
-            self.engine.execute(f'TRUNCATE TABLE {table}')
+        """Insert rows into table, in a single transaction."""
         self.table_name = table
-        self.engine.execute(self.table.insert(), rows)
+        target_table = self.table
+        with self.engine.begin() as connection:
+            if self.engine.dialect.name == 'postgresql':
+                # Don't wait for the WAL to be flushed to disk, a crash can only lose the whole load.
+                connection.execute(text('SET LOCAL synchronous_commit = OFF'))
+            if replace:
+                connection.execute(f'TRUNCATE TABLE {table}')
+            self._bulk_load(rows, target_table, connection)
         return self.construct_response(rows, table)
 
-    def fetch_rows(self, query):
+    def execute(self, query, params=None, **execution_options):
+        """Execute query, binding params by name (`:name`) if given."""
+        if params:
+            engine = self.engine.execution_options(compiled_cache=self._compiled_cache, **execution_options)
+            statement = _cached_text(query) if isinstance(query, str) else query
+            return engine.execute(statement, **params)
+        engine = self.engine.execution_options(**execution_options) if execution_options else self.engine
+        return engine.execute(query)
+
+    def _bulk_load(self, rows, table, connection):
+        """Load rows (dicts keyed by column name) into table with the engine's native bulk loader,
+        or with multi-row INSERT statements if it has none (MySQL, Redshift, ...).
+        On Postgres, rows holding values that don't survive CSV (JSON, arrays, bytes, ...)
+        are inserted too, so that each column's bind processor converts them.
+        Runs on the given connection, committing is up to the caller."""
+        dialect = self.engine.dialect.name
+        if dialect == 'postgresql' and all(_is_copy_scalar(value) for row in rows for value in row.values()):
+            self._copy_from_csv(rows, table, connection)
+        elif dialect == 'bigquery':
+            self._load_table_from_json(rows, table, connection)
+        else:
+            for chunk in _chunked(rows, INSERT_BATCH_SIZE):
+                connection.execute(table.insert().values(chunk))
+
+    def _copy_from_csv(self, rows, table, connection):
+        """Stream rows into a Postgres table with COPY FROM STDIN."""
+        preparer = self.engine.dialect.identifier_preparer
+        columns = list(rows[0].keys())
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(['\\N' if row[column] is None else row[column] for column in columns])
+        buffer.seek(0)
+        copy_query = "COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+            table=preparer.format_table(table),
+            columns=', '.join(map(preparer.quote, columns)),
+        )
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(copy_query, buffer)
+        finally:
+            cursor.close()
+
+    def _load_table_from_json(self, rows, table, connection):
+        """Load rows into a BigQuery table with a load job rather than DML."""
+        from google.cloud.bigquery import LoadJobConfig
+        # the BigQuery DB-API connection wraps a google.cloud.bigquery.Client
+        client = connection.connection._client
+        table_id = table.name if '.' in table.name else f'{self.engine.dialect.dataset_id}.{table.name}'
+        json_rows = [{k: _json_value(v) for k, v in row.items()} for row in rows]
+        # load with the table's own schema, rather than one autodetected from the rows
+        job_config = LoadJobConfig(schema=client.get_table(table_id).schema)
+        client.load_table_from_json(json_rows, table_id, job_config=job_config).result()
+
+    def fetch_rows(self, query, params=None):
         """Fetch all rows via query."""
-        rows = self.engine.execute(query).fetchall()
+        rows = self.execute(query, params).fetchall()
         return rows
 
-    def query(self, query):
-        return [dict(r) for r in self.fetch_rows(query)]
+    def query(self, query, params=None):
+        """Fetch all rows via query as dicts keyed by column name."""
+        result = self.execute(query, params)
+        # look up the column names once, rather than once per row
+        keys = result.keys()
+        return [dict(zip(keys, row)) for row in result.fetchall()]
+
+    def query_one(self, query, params=None):
+        """Fetch only the first row via query, or None if there are no rows."""
+        return self.execute(query, params).first()
+
+    def query_scalar(self, query, params=None):
+        """Fetch the first column of the first row via query."""
+        return self.execute(query, params).scalar()
+
+    def query_iter(self, query, params=None, size=50000):
+        """Lazily fetch rows via query, `size` rows at a time, so that large
+        result sets never have to be held in memory all at once."""
+        return _iter_result(self.execute(query, params, stream_results=True), size)
 
     @staticmethod
     def construct_response(rows, table):
@@ -106,27 +414,53 @@ class DataClient:
             start_datetime: datetime.datetime = None,
             end_datetime: datetime.datetime = None,
             timestamp_fields: List[str] = None,
-            stick_to_dates: bool = False
+            stick_to_dates: bool = False,
+            count_cache: Dict = None,
     ) -> int:
         """
         Optionally pass in timestamp fields and time range to limit the query_range.
+        Pass a count_cache dict to remember counts in it, e.g. for the duration of one run,
+        so that asking for the same count again doesn't query the table again.
         """
         if not field_name:
             field_name = "*"
-        count_query = f"""
-        SELECT COUNT({field_name}) AS count FROM {table_name}
-        """
-        where_clause = _construct_where_clause_from_timerange(
+        where_clause, params = _construct_where_clause_from_timerange(
             start_datetime=start_datetime,
             end_datetime=end_datetime,
             timestamp_fields=timestamp_fields,
             stick_to_dates=stick_to_dates,
         )
-        count_query += where_clause
+        count_query = _count_query(table_name, field_name, where_clause)
+        cache_key = (self, count_query, tuple(sorted(params.items())))
+        if count_cache is not None and cache_key in count_cache:
+            return count_cache[cache_key]
         logging.debug("Count query is %s" % count_query)
-        result = self.query(count_query)[0]['count']
+        result = self.query_scalar(count_query, params)
+        if count_cache is not None:
+            count_cache[cache_key] = result
         return result
 
+    def ids_query(self, table_name, key_field, timestamp_fields: List[str] = None, params: Dict = None):
+        """Query selecting the keys of a table as `id`, limited to the time range in params
+        as returned by _construct_where_clause_from_timerange."""
+        params = params or {}
+        return _ids_query(
+            table_name,
+            key_field,
+            tuple(timestamp_fields or ()),
+            'start_datetime' in params,
+            'end_datetime' in params,
+            'UNION DISTINCT' if self.engine.dialect.name == 'bigquery' else 'UNION',
+        )
+
+    def existing_ids(self, table_name, key_field, ids) -> Set:
+        """Find which of the given keys exist in the table."""
+        query = _existing_ids_query(table_name, key_field)
+        found = set()
+        for chunk in _chunked(ids, INSERT_BATCH_SIZE):
+            found.update(_iter_ids(self.execute(query, {'ids': chunk})))
+        return found
+
     def find_duplicate_keys(self, table_name, key_field):
         """Find if a table has duplicates by a certain column, if so return all the instances that
         have duplicates together with their counts."""
@@ -138,6 +472,23 @@ class DataClient:
         """
         return self.fetch_rows(query)
 
+    def create_staging_table(self, column_type):
+        """Create an empty scratch table with a single `id` column of the given type.
+        The caller is responsible for dropping it when done."""
+        staging_table = Table(
+            f'_elt_tools_ids_{uuid.uuid4().hex}',
+            MetaData(bind=self.engine),
+            Column('id', column_type),
+        )
+        staging_table.create()
+        return staging_table
+
+    def stage_ids(self, staging_table, ids, batch_size=100000):
+        """Bulk load ids into a staging table in batches, in a single transaction."""
+        with self.engine.begin() as connection:
+            for chunk in _chunked(ids, batch_size):
+                self._bulk_load([{'id': id} for id in chunk], staging_table, connection)
+
 
 class ELTDBPair:
     # Override these if you want
@@ -145,10 +496,17 @@ class ELTDBPair:
     elt_pairs = ELT_PAIRS
     databases = DATABASES
 
-    def __init__(self, name: str, source: DataClient, target: DataClient):
+    def __init__(self, name: str, source: DataClient, target: DataClient, federated_schema: str = None):
+        """
+        Pass federated_schema if the target database can query the source tables itself,
+        e.g. via postgres_fdw or BigQuery external tables, as `{federated_schema}.{table_name}`.
+        Orphans are then found with a single query on the target.
+        """
         self.name = name
         self.source = source
         self.target = target
+        self.federated_schema = federated_schema
+        self._source_id_blooms_lock = threading.Lock()
 
     @classmethod
     def from_settings(cls, name=None, db_key=None):
@@ -159,7 +517,12 @@ class ELTDBPair:
         source_target_settings = cls.elt_pairs[db_key]
         source_client = DataClient.from_settings(source_target_settings['source'], databases=cls.databases)
         target_client = DataClient.from_settings(source_target_settings['target'], databases=cls.databases)
-        return cls(name, source_client, target_client)
+        return cls(
+            name,
+            source_client,
+            target_client,
+            federated_schema=source_target_settings.get('federated_schema'),
+        )
 
     def __repr__(self):
         return self.name
@@ -172,23 +535,27 @@ class ELTDBPair:
             start_datetime: datetime.datetime = None,
             end_datetime: datetime.datetime = None,
             timestamp_fields: List[str] = None,
-            stick_to_dates: bool = False
+            stick_to_dates: bool = False,
+            count_cache: Dict = None,
     ) -> int:
-        return self.target.count(
-            table_name,
-            field_name=field_name,
-            start_datetime=start_datetime,
-            end_datetime=end_datetime,
-            timestamp_fields=timestamp_fields,
-            stick_to_dates=stick_to_dates,
-        ) - self.source.count(
-            table_name,
+        count_kwargs = dict(
             field_name=field_name,
             start_datetime=start_datetime,
             end_datetime=end_datetime,
             timestamp_fields=timestamp_fields,
             stick_to_dates=stick_to_dates,
+            count_cache=count_cache,
         )
+        if self.federated_schema:
+            # the target sees the source table itself
+            source, source_table_name = self.target, f'{self.federated_schema}.{table_name}'
+        else:
+            source, source_table_name = self.source, table_name
+        # The two counts are independent, so run them concurrently.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            target_count = executor.submit(self.target.count, table_name, **count_kwargs)
+            source_count = executor.submit(source.count, source_table_name, **count_kwargs)
+            return target_count.result() - source_count.result()
 
     def find_orphans(
             self,
@@ -197,28 +564,195 @@ class ELTDBPair:
             start_datetime: datetime.datetime = None,
             end_datetime: datetime.datetime = None,
             timestamp_fields: List[str] = None,
-            stick_to_dates: bool = False
+            stick_to_dates: bool = False,
+            use_bloom_filter: bool = False,
+            bloom_error_rate: float = 0.001,
+            check_counts: bool = True,
+            source_id_blooms: Dict = None,
+            count_cache: Dict = None,
     ) -> Set:
         """
         Find orphaned records in BQ for which their source parents were deleted.
         Optionally pass in timestamp fields and time range to limit the amount of records
         to compare for orphans (for use on large tables).
+        Set use_bloom_filter to hold source ids in a Bloom filter rather than a set. This
+        uses a fraction of the memory, at the cost of missing about `bloom_error_rate` of
+        the orphans on each run. With a time range, the filters are built per day and orphans
+        are confirmed against the source table. Pass the same source_id_blooms dict to several
+        calls to share the daily filters between them, as the segments of
+        remove_orphans_from_target_with_binary_search do. Likewise for counts and count_cache,
+        see DataClient.count.
+        With a time range, the ids are only compared if source and target counts differ.
+        Set check_counts to False to skip that check and save its round-trips when the
+        counts are known to differ.
+        If the pair has a federated_schema, the target computes the counts and orphans by itself.
         """
-        all_ids_query = f"""
-            SELECT {key_field} AS id FROM {table_name}
+        where_clause, params = _construct_where_clause_from_timerange(
+            start_datetime=start_datetime,
+            end_datetime=end_datetime,
+            timestamp_fields=timestamp_fields,
+            stick_to_dates=stick_to_dates,
+        )
+        # the Bloom filter is sized with the source count already taken for the comparison
+        count_cache = {} if count_cache is None else count_cache
+        # First compare counts on limited date range to skip id comparison if no difference
+        if where_clause and check_counts:
+            count_diff = self.compare_counts(
+                table_name,
+                start_datetime=start_datetime,
+                end_datetime=end_datetime,
+                timestamp_fields=timestamp_fields,
+                stick_to_dates=stick_to_dates,
+                count_cache=count_cache,
+            )
+            if count_diff == 0:
+                return set()
+
+        if self.federated_schema:
+            return self._orphans_sql(table_name, key_field, timestamp_fields, params)
+
+        if use_bloom_filter and start_datetime and end_datetime:
+            return self._find_orphans_with_source_id_cache(
+                table_name,
+                key_field,
+                start_datetime,
+                end_datetime,
+                timestamp_fields,
+                params,
+                bloom_error_rate,
+                {} if source_id_blooms is None else source_id_blooms,
+            )
+
+        source_ids_query = self.source.ids_query(table_name, key_field, timestamp_fields, params)
+        target_ids_query = self.target.ids_query(table_name, key_field, timestamp_fields, params)
+        logging.debug("Id lookup for orphan query: %s" % target_ids_query)
+
+        def read_source_ids():
+            if use_bloom_filter:
+                # size the filter before streaming, so as to hold one source connection at a time
+                source_ids = BloomFilter(self.source.count(
+                    table_name,
+                    start_datetime=start_datetime,
+                    end_datetime=end_datetime,
+                    timestamp_fields=timestamp_fields,
+                    stick_to_dates=stick_to_dates,
+                    count_cache=count_cache,
+                ), error_rate=bloom_error_rate)
+                source_ids.update(_iter_ids(self.source.query_iter(source_ids_query, params)))
+            else:
+                source_ids = _collect_ids(self.source.query_iter(source_ids_query, params))
+            return source_ids
+
+        # Read the source ids while the target runs its id query.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            source_ids = executor.submit(read_source_ids)
+            target_result = self.target.execute(target_ids_query, params, stream_results=True)
+            try:
+                source_ids = source_ids.result()
+            except BaseException:
+                target_result.close()
+                raise
+
+        rows = _iter_result(target_result)
+        if isinstance(source_ids, numpy.ndarray):
+            target_ids = _collect_ids(rows)
+            logging.debug("Comparing %d target ids to %d source ids." % (len(target_ids), len(source_ids)))
+            if isinstance(target_ids, numpy.ndarray):
+                orphans = set(numpy.setdiff1d(target_ids, source_ids).tolist())
+            else:
+                # the target holds ids that don't fit in the source's int64 array
+                orphans = target_ids - set(source_ids.tolist())
+        else:
+            orphans = {id for id in _iter_ids(rows) if id not in source_ids}
+        return orphans
+
+    def _find_orphans_with_source_id_cache(
+            self,
+            table_name,
+            key_field,
+            start_datetime,
+            end_datetime,
+            timestamp_fields,
+            params,
+            bloom_error_rate,
+            source_id_blooms,
+    ) -> Set:
+        """
+        Check the target ids in the time range against Bloom filters of the source ids of
+        each day in the range, each id only against the filters of its own days. Ids missing
+        from the filters are only candidates, e.g. when the source row moved to another day,
+        so they are confirmed against the whole source table.
         """
+        blooms = {
+            day: self._source_id_bloom(source_id_blooms, table_name, key_field, timestamp_fields, day, bloom_error_rate)
+            for day in _days_in_range(start_datetime, end_datetime)
+        }
+        rows = self.target.query_iter(_ids_by_day_query(table_name, key_field, tuple(timestamp_fields)), params)
+        cast = None
+        candidates = set()
+        for id, day in rows:
+            if cast is None:
+                cast = int if isinstance(id, int) else str
+            id = cast(id)
+            if id not in blooms.get(_as_date(day), ()):
+                candidates.add(id)
+        logging.debug("Confirming %d orphan candidates in source %s." % (len(candidates), table_name))
+        return candidates - self.source.existing_ids(table_name, key_field, candidates)
 
-        where_clause = _construct_where_clause_from_timerange(
+    def _source_id_bloom(self, source_id_blooms, table_name, key_field, timestamp_fields, day, bloom_error_rate) -> BloomFilter:
+        """Get the Bloom filter of source ids on day from source_id_blooms, building it the first
+        time it is asked for. Concurrent callers asking for the same filter wait for it to be built once."""
+        cache_key = (table_name, key_field, tuple(timestamp_fields), day)
+        with self._source_id_blooms_lock:
+            future = source_id_blooms.get(cache_key)
+            is_builder = future is None
+            if is_builder:
+                future = source_id_blooms[cache_key] = Future()
+        if is_builder:
+            try:
+                day_range = dict(
+                    start_datetime=datetime.datetime.combine(day, datetime.time()),
+                    end_datetime=datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()),
+                    timestamp_fields=timestamp_fields,
+                )
+                _, params = _construct_where_clause_from_timerange(**day_range)
+                bloom = BloomFilter(self.source.count(table_name, **day_range), error_rate=bloom_error_rate)
+                rows = self.source.query_iter(self.source.ids_query(table_name, key_field, timestamp_fields, params), params)
+                bloom.update(_iter_ids(rows))
+                future.set_result(bloom)
+            except BaseException as e:
+                with self._source_id_blooms_lock:
+                    del source_id_blooms[cache_key]
+                future.set_exception(e)
+                raise
+        return future.result()
+
+    def find_orphans_sql(
+            self,
+            table_name,
+            key_field,
+            start_datetime: datetime.datetime = None,
+            end_datetime: datetime.datetime = None,
+            timestamp_fields: List[str] = None,
+            stick_to_dates: bool = False,
+            check_counts: bool = True,
+    ) -> Set:
+        """
+        Same as find_orphans, but let the target database compute the difference.
+        Source ids are staged into a scratch table on the target and anti-joined
+        against the target ids, so only the orphaned ids come back over the network.
+        Falls back to find_orphans if no scratch table can be created on the target.
+        """
+        where_clause, params = _construct_where_clause_from_timerange(
             start_datetime=start_datetime,
             end_datetime=end_datetime,
             timestamp_fields=timestamp_fields,
             stick_to_dates=stick_to_dates,
         )
-        all_ids_query += where_clause
-        logging.debug("Id lookup for orphan query: %s" % all_ids_query)
+        source_ids_query = self.source.ids_query(table_name, key_field, timestamp_fields, params)
+        target_ids_query = self.target.ids_query(table_name, key_field, timestamp_fields, params)
 
-        # First compare counts on limited date range to skip id comparison if no difference
-        if where_clause:
+        if where_clause and check_counts:
             count_diff = self.compare_counts(
                 table_name,
                 start_datetime=start_datetime,
@@ -229,21 +763,53 @@ class ELTDBPair:
             if count_diff == 0:
                 return set()
 
-        def format_id(row):
-            id = row['id']
-            if isinstance(id, int):
-                return id
-            else:
-                return str(id)  # cast to str if UUID
+        key_type = self.target.get_table(table_name).c[key_field].type
+        try:
+            staging_table = self.target.create_staging_table(key_type)
+        except SQLAlchemyError as e:
+            logging.warning("Could not create a staging table on target (%s), "
+                            "falling back to comparing ids in Python." % e)
+            return self.find_orphans(
+                table_name,
+                key_field,
+                start_datetime=start_datetime,
+                end_datetime=end_datetime,
+                timestamp_fields=timestamp_fields,
+                stick_to_dates=stick_to_dates,
+                check_counts=False,
+            )
 
-        rows = self.target.fetch_rows(all_ids_query)
-        target_ids = set(map(format_id, rows))
+        try:
+            rows = self.source.query_iter(source_ids_query, params)
+            self.target.stage_ids(staging_table, _iter_ids(rows))
+            orphans_query = f"""
+            SELECT t.id FROM ({target_ids_query}) t
+            WHERE NOT EXISTS (SELECT 1 FROM {staging_table.name} s WHERE s.id = t.id)
+            """
+            logging.debug("Orphan anti-join query: %s" % orphans_query)
+            rows = self.target.fetch_rows(orphans_query, params)
+        finally:
+            staging_table.drop()
 
-        rows = self.source.fetch_rows(all_ids_query)
-        source_ids = set(map(format_id, rows))
+        return set(_iter_ids(rows))
 
-        orphans = target_ids - source_ids
-        return orphans
+    def _orphans_sql(self, table_name, key_field, timestamp_fields, params) -> Set:
+        """Find orphans with a single EXCEPT query on the target, reading the source
+        table through the federated schema."""
+        except_ = 'EXCEPT DISTINCT' if self.target.engine.dialect.name == 'bigquery' else 'EXCEPT'
+        target_ids_query = self.target.ids_query(table_name, key_field, timestamp_fields, params)
+        source_ids_query = self.target.ids_query(
+            f'{self.federated_schema}.{table_name}', key_field, timestamp_fields, params
+        )
+        # wrap both sides, as they may be UNIONs themselves
+        orphans_query = f"""
+        SELECT id FROM ({target_ids_query}) target_ids
+        {except_}
+        SELECT id FROM ({source_ids_query}) source_ids
+        """
+        logging.debug("Orphan lookup through federated schema: %s" % orphans_query)
+        rows = self.target.query_iter(orphans_query, params)
+        return set(_iter_ids(rows))
 
     def remove_orphans_from_target(
             self,
@@ -252,7 +818,11 @@ class ELTDBPair:
             start_datetime: datetime.datetime = None,
             end_datetime: datetime.datetime = None,
             timestamp_fields: List[str] = None,
-            stick_to_dates: bool = False
+            stick_to_dates: bool = False,
+            use_bloom_filter: bool = False,
+            check_counts: bool = True,
+            source_id_blooms: Dict = None,
+            count_cache: Dict = None,
     ) -> int:
         orphans = self.find_orphans(
             table_name,
@@ -260,28 +830,53 @@ class ELTDBPair:
             start_datetime=start_datetime,
             end_datetime=end_datetime,
             timestamp_fields=timestamp_fields,
-            stick_to_dates=stick_to_dates
+            stick_to_dates=stick_to_dates,
+            use_bloom_filter=use_bloom_filter,
+            check_counts=check_counts,
+            source_id_blooms=source_id_blooms,
+            count_cache=count_cache,
         )
         num_orphans = len(orphans)
-        def format_primary_key(k):
-            if isinstance(k, int):
-                return str(k)
-            else:
-                return "'%s'" % str(k)
-        orphan_ids_csv = ','.join(map(format_primary_key, orphans))
 
-        if not orphan_ids_csv:
+        if not orphans:
             logging.info("No orphans found for table %s" % table_name)
         else:
             logging.info("Found %d orphaned records in target %s." % (num_orphans, table_name))
+            self._delete_from_target(table_name, key_field, orphans)
+
+        return num_orphans
+
+    def _delete_from_target(self, table_name, key_field, ids):
+        """
+        Delete the records with the given keys from the target table. The keys are never
+        inlined into the query text, which would grow with every key. Postgres and BigQuery
+        receive them as an array parameter, BigQuery in batches of BIGQUERY_DELETE_BATCH_SIZE
+        to stay within its request size limit, other databases through a staging table.
+        """
+        dialect = self.target.engine.dialect
+        key_type = self.target.get_table(table_name).c[key_field].type
+        if dialect.name in ('postgresql', 'bigquery'):
+            delete_query = _delete_ids_query(dialect, table_name, key_field, key_type)
+            logging.info(delete_query)
+            if dialect.name == 'bigquery':
+                chunks = _chunked(ids, BIGQUERY_DELETE_BATCH_SIZE)
+            else:
+                chunks = [list(ids)]
+            for chunk in chunks:
+                self.target.execute(delete_query, {'ids': chunk})
+            return
+
+        staging_table = self.target.create_staging_table(key_type)
+        try:
+            self.target.stage_ids(staging_table, ids)
             delete_query = f"""
-            DELETE {table_name} 
-            WHERE {key_field} IN ({orphan_ids_csv}) 
+            DELETE FROM {table_name}
+            WHERE {key_field} IN (SELECT id FROM {staging_table.name})
             """
             logging.info(delete_query)
-            self.target.query(delete_query)
-
-        return num_orphans
+            self.target.execute(delete_query)
+        finally:
+            staging_table.drop()
 
     def remove_orphans_from_target_with_binary_search(
             self,
@@ -293,127 +888,232 @@ class ELTDBPair:
             stick_to_dates: bool = False,
             thres=10000,
             min_segment_size=datetime.timedelta(seconds=10),
+            num_buckets=100,
+            max_workers=4,
+            use_bloom_filter: bool = False,
     ):
         """
-        Do binary search on table by recursively bifurcating the date range
-        until the number of records in that range drops below the threshold.
-        Once, below the threshold, find and remove the orphans for that segment.
+        Split the date range into segments holding fewer than `thres` target records each,
+        then find and remove the orphans segment by segment, `max_workers` at a time.
+        Segments are derived from a histogram of the target table over `num_buckets` buckets,
+        fetched in a single query. Buckets still over the threshold are split up further
+        with a histogram of their own, until they are as small as `min_segment_size`.
+        Dialects without histogram support fall back to bisecting the range with counts.
+        With use_bloom_filter, the segments share daily Bloom filters of the source ids for the
+        duration of the run, see find_orphans. Counts are likewise remembered for the run.
         :return: Total number of records removed.
         """
-        # If time range is not set, fetch it from the target database
-        if not start_datetime:
-            query = """
-            SELECT {select_stmt}
-            FROM {table_name}
-            """.format(
-                select_stmt=', '.join(map(lambda x: 'MIN({0}) AS {0} '.format(x), timestamp_fields)),
-                table_name=table_name,
-            )
-            result = self.target.query(query)
-            start_datetime = min(result[0].values())
-        if not end_datetime:
-            query = """
-            SELECT {select_stmt}
-            FROM {table_name}
-            """.format(
-                select_stmt=', '.join(map(lambda x: 'MAX({0}) AS {0} '.format(x), timestamp_fields)),
-                table_name=table_name,
-            )
-            result = self.target.query(query)
-            end_datetime = max(result[0].values())
-            
+        # If time range is not set, fetch it from the target database in one go
+        if not start_datetime or not end_datetime:
+            # typed by the reflected columns, so that the bounds come back as datetimes
+            # also where the driver returns strings (e.g. sqlite)
+            columns = self.target.get_table(table_name).c
+            query = select(list(chain.from_iterable(
+                (func.min(columns[field]).label(f'min_{field}'), func.max(columns[field]).label(f'max_{field}'))
+                for field in timestamp_fields
+            )))
+            result = self.target.query_one(query)
+            if not start_datetime:
+                start_datetime = min(result[f'min_{field}'] for field in timestamp_fields)
+            if not end_datetime:
+                end_datetime = max(result[f'max_{field}'] for field in timestamp_fields)
+
         if stick_to_dates:
-            if start_datetime:
-                start_datetime = start_datetime.date()
-            if end_datetime:
-                end_datetime = end_datetime.date()
-
-        def avg_datetime(start, end):
-           return start + (end - start) / 2
-
-        def bifurcate_time_range(start, end):
-            halfway = avg_datetime(start, end)
-            return start, halfway, end
-
-        removed_count = 0
-        count1 = count2 = 0
-        start, halfway, end = bifurcate_time_range(start_datetime, end_datetime)
-        logging.debug(f"Start date is : {start}")
-        logging.debug(f"Halfway date is : {halfway}")
-        logging.debug(f"End date is : {end}")
-
-        if start != halfway:
-            count1 = self.target.count(
-                table_name,
-                field_name=key_field,
-                start_datetime=start,
-                end_datetime=halfway,
-                timestamp_fields=timestamp_fields,
-                stick_to_dates=stick_to_dates,
-            )
-        if end != halfway:
-            count2 = self.target.count(
-                table_name,
-                field_name=key_field,
-                start_datetime=halfway,
-                end_datetime=end,
-                timestamp_fields=timestamp_fields,
-                stick_to_dates=stick_to_dates,
-            )
+            # keep segment boundaries on midnight
+            start_datetime = datetime.datetime.combine(start_datetime, datetime.time())
+            end_datetime = datetime.datetime.combine(end_datetime, datetime.time())
+            min_segment_size = max(min_segment_size, datetime.timedelta(days=1))
 
-        logging.debug(f"Count of range 1 is {count1}")
-        logging.debug(f"Count of range 2 is {count2}")
+        # Built afresh on every run, so that later deletions in the source are seen
+        source_id_blooms = {}
+        count_cache = {}
+        segments = self._plan_segments(
+            table_name,
+            start_datetime,
+            end_datetime,
+            timestamp_fields,
+            stick_to_dates,
+            thres,
+            min_segment_size,
+            num_buckets,
+            count_cache,
+        )
+        # All segments share one pool, so that no more than max_workers run at once.
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    self.remove_orphans_from_target,
+                    table_name,
+                    key_field,
+                    start_datetime=start,
+                    end_datetime=end,
+                    timestamp_fields=timestamp_fields,
+                    stick_to_dates=stick_to_dates,
+                    use_bloom_filter=use_bloom_filter,
+                    source_id_blooms=source_id_blooms,
+                    count_cache=count_cache,
+                )
+                for start, end in segments
+            ]
+            return sum(future.result() for future in futures)
 
-        # exit conditions
-        if start == halfway or end == halfway or (halfway - start) < min_segment_size:
-            return self.remove_orphans_from_target(
-                table_name,
-                key_field,
-                start_datetime=start,
-                end_datetime=end,
-                timestamp_fields=timestamp_fields,
-                stick_to_dates=stick_to_dates,
-            )
-        if count1 == 0 and count2 == 0:
-            return 0
-        if count1 < thres and count2 < thres:
-            return self.remove_orphans_from_target(
-                table_name,
-                key_field,
-                start_datetime=start,
-                end_datetime=halfway,
-                timestamp_fields=timestamp_fields,
-                stick_to_dates=stick_to_dates,
-            ) + self.remove_orphans_from_target(
+    def _plan_segments(
+            self,
+            table_name,
+            start_datetime: datetime.datetime,
+            end_datetime: datetime.datetime,
+            timestamp_fields: List[str],
+            stick_to_dates: bool,
+            thres,
+            min_segment_size: datetime.timedelta,
+            num_buckets,
+            count_cache: Dict,
+    ) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+        """
+        Split the time range into (start, end) segments of fewer than `thres` target records,
+        using a histogram of the target. Buckets still over the threshold get a histogram of
+        their own, until they are as small as `min_segment_size`.
+        """
+        if end_datetime - start_datetime <= min_segment_size:
+            return [(start_datetime, end_datetime)]
+        if self.target.engine.dialect.name not in SECONDS_SINCE_SQL:
+            logging.info("No histogram support for dialect %s, bisecting with counts instead."
+                         % self.target.engine.dialect.name)
+            return self._bisect_segments(
                 table_name,
-                key_field,
-                start_datetime=halfway,
-                end_datetime=end,
-                timestamp_fields=timestamp_fields,
-                stick_to_dates=stick_to_dates,
+                start_datetime,
+                end_datetime,
+                timestamp_fields,
+                stick_to_dates,
+                thres,
+                min_segment_size,
+                count_cache,
             )
 
-        # recursion conditions
-        if count1 >= thres or count2 >= thres:
-            removed_count += self.remove_orphans_from_target_with_binary_search(
-                table_name,
-                key_field,
-                start_datetime=start,
-                end_datetime=halfway,
-                timestamp_fields=timestamp_fields,
-                stick_to_dates=stick_to_dates,
-                thres=thres,
-            ) + self.remove_orphans_from_target_with_binary_search(
-                table_name,
-                key_field,
-                start_datetime=halfway,
-                end_datetime=end,
-                timestamp_fields=timestamp_fields,
+        bucket_size = max((end_datetime - start_datetime) / num_buckets, min_segment_size)
+        bucket_size = datetime.timedelta(seconds=math.ceil(bucket_size.total_seconds()))
+        if stick_to_dates:
+            bucket_size = datetime.timedelta(days=math.ceil(bucket_size / datetime.timedelta(days=1)))
+        bucket_counts = self._target_histogram(
+            table_name,
+            start_datetime,
+            end_datetime,
+            bucket_size,
+            timestamp_fields,
+            stick_to_dates,
+        )
+        logging.debug(f"Histogram of {table_name} from {start_datetime} by {bucket_size}: {bucket_counts}")
+        if not any(bucket_counts):
+            return []
+
+        # Greedily merge adjacent buckets into segments of at most `thres` records.
+        merged = []  # [first_bucket, last_bucket, count]
+        for bucket, count in enumerate(bucket_counts):
+            if merged and merged[-1][2] + count < thres:
+                merged[-1][1] = bucket
+                merged[-1][2] += count
+            else:
+                merged.append([bucket, bucket, count])
+
+        segments = []
+        for first_bucket, last_bucket, count in merged:
+            start = start_datetime + first_bucket * bucket_size
+            end = min(start_datetime + (last_bucket + 1) * bucket_size, end_datetime)
+            logging.debug(f"Segment {start} to {end} has {count} records")
+            if count >= thres and bucket_size > min_segment_size:
+                segments.extend(self._plan_segments(
+                    table_name,
+                    start,
+                    end,
+                    timestamp_fields,
+                    stick_to_dates,
+                    thres,
+                    min_segment_size,
+                    num_buckets,
+                    count_cache,
+                ))
+            else:
+                segments.append((start, end))
+        return segments
+
+    def _bisect_segments(
+            self,
+            table_name,
+            start_datetime: datetime.datetime,
+            end_datetime: datetime.datetime,
+            timestamp_fields: List[str],
+            stick_to_dates: bool,
+            thres,
+            min_segment_size: datetime.timedelta,
+            count_cache: Dict,
+    ) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+        """Split the time range in halves until each holds fewer than `thres` target records,
+        counting every half. For dialects without a histogram query. The counts are kept in
+        count_cache, where the segments' own count comparisons find them."""
+        count = self.target.count(
+            table_name,
+            start_datetime=start_datetime,
+            end_datetime=end_datetime,
+            timestamp_fields=timestamp_fields,
+            stick_to_dates=stick_to_dates,
+            count_cache=count_cache,
+        )
+        halfway = start_datetime + (end_datetime - start_datetime) / 2
+        if stick_to_dates:
+            halfway = datetime.datetime.combine(halfway.date(), datetime.time())
+        if count == 0:
+            return []
+        if count < thres or halfway - start_datetime < min_segment_size or halfway == start_datetime:
+            return [(start_datetime, end_datetime)]
+        return self._bisect_segments(
+            table_name, start_datetime, halfway, timestamp_fields, stick_to_dates, thres, min_segment_size, count_cache,
+        ) + self._bisect_segments(
+            table_name, halfway, end_datetime, timestamp_fields, stick_to_dates, thres, min_segment_size, count_cache,
+        )
+
+    def _target_histogram(
+            self,
+            table_name,
+            start_datetime: datetime.datetime,
+            end_datetime: datetime.datetime,
+            bucket_size: datetime.timedelta,
+            timestamp_fields: List[str],
+            stick_to_dates: bool = False,
+    ) -> List[int]:
+        """
+        Count the target records in each `bucket_size` wide bucket of the time range with one query.
+        A record is counted once for every timestamp field in range, so with several timestamp
+        fields the counts are an upper bound.
+        """
+        seconds_since = SECONDS_SINCE_SQL[self.target.engine.dialect.name]
+        params = {}
+        bucket_queries = []
+        for timestamp_field in timestamp_fields:
+            where_clause, params = _construct_where_clause_from_timerange(
+                start_datetime=start_datetime,
+                end_datetime=end_datetime,
+                timestamp_fields=[timestamp_field],
                 stick_to_dates=stick_to_dates,
-                thres=thres,
             )
-        
-        return removed_count
+            seconds = seconds_since.format(field=timestamp_field, start=':start_datetime')
+            bucket_queries.append(f"""
+            SELECT FLOOR(({seconds}) / :bucket_seconds) AS bucket
+            FROM {table_name}{where_clause}
+            """)
+        histogram_query = f"""
+        SELECT bucket, COUNT(*) AS count
+        FROM ({' UNION ALL '.join(bucket_queries)}) AS buckets
+        GROUP BY bucket
+        """
+        params['bucket_seconds'] = int(bucket_size.total_seconds())
+
+        num_buckets = math.ceil((end_datetime - start_datetime) / bucket_size)
+        bucket_counts = [0] * num_buckets
+        for row in self.target.fetch_rows(histogram_query, params):
+            bucket = int(row['bucket'])
+            assert 0 <= bucket < num_buckets, f"Bucket {bucket} of {table_name} is out of the time range"
+            bucket_counts[bucket] += row['count']
+        return bucket_counts
 
 
     def find_missing_in_target(self):
@@ -1,5 +1,5 @@
+from sqlalchemy import event
 from sqlalchemy.engine import create_engine
-from sqlalchemy.sql import text
 
 from elt_tools.settings import DATABASES
 
@@ -16,8 +16,17 @@ def bigquery_engine(gcp_project=None, dataset_id=None, gcp_credentials=None):
 
 def redshift_engine(sql_alchemy_conn_string=None, default_schema='public', connect_timeout=3600):
     engine = create_engine(sql_alchemy_conn_string, connect_args={'connect_timeout': connect_timeout})
-    engine.execute(text('SET search_path TO %s,public;' % default_schema).execution_options(
-        autocommit=True))
+
+    # Set the search path on every pooled connection, not just the first one,
+    # since queries may run on several connections at once.
+    @event.listens_for(engine, 'connect')
+    def set_search_path(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SET search_path TO %s,public;' % default_schema)
+        cursor.close()
+        # commit, or the pool's rollback on checkin undoes the SET
+        dbapi_connection.commit()
+
     return engine
 
 
@@ -1,5 +1,24 @@
 import datetime
-from elt_tools.client import _construct_where_clause_from_timerange
+import threading
+import uuid
+from decimal import Decimal
+from types import SimpleNamespace
+import numpy
+from google.cloud.bigquery import SchemaField
+from sqlalchemy import Integer, create_engine, event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import UUID
+from elt_tools import client as client_module
+from elt_tools.bloom import BloomFilter
+from elt_tools.client import (
+    SECONDS_SINCE_SQL,
+    DataClient,
+    ELTDBPair,
+    _collect_ids,
+    _construct_where_clause_from_timerange,
+    _delete_ids_query,
+    _ids_query,
+)
 
 
 def test_construct_where_clause_with_datetimes():
@@ -7,16 +26,17 @@ def test_construct_where_clause_with_datetimes():
     end_datetime = datetime.datetime(2020, 2, 1, 0, 0, 0)
     timestamp_fields = ['created_at', 'updated_at']
 
-    where_clause = _construct_where_clause_from_timerange(
+    where_clause, params = _construct_where_clause_from_timerange(
         start_datetime=start_datetime,
         end_datetime=end_datetime,
         timestamp_fields=timestamp_fields,
         stick_to_dates=False,  # !important
     )
 
-    answ = " WHERE (created_at >= '2020-01-01 00:00:00' AND created_at < '2020-02-01 00:00:00')" \
-           " OR (updated_at >= '2020-01-01 00:00:00' AND updated_at < '2020-02-01 00:00:00')"
+    answ = " WHERE (created_at >= :start_datetime AND created_at < :end_datetime)" \
+           " OR (updated_at >= :start_datetime AND updated_at < :end_datetime)"
     assert where_clause == answ, where_clause
+    assert params == {'start_datetime': '2020-01-01 00:00:00', 'end_datetime': '2020-02-01 00:00:00'}
 
 
 def test_construct_where_clause_with_dates():
@@ -24,13 +44,355 @@ def test_construct_where_clause_with_dates():
     end_datetime = datetime.datetime(2020, 2, 1,)
     timestamp_fields = ['created_at', 'updated_at']
 
-    where_clause = _construct_where_clause_from_timerange(
+    where_clause, params = _construct_where_clause_from_timerange(
         start_datetime=start_datetime,
         end_datetime=end_datetime,
         timestamp_fields=timestamp_fields,
         stick_to_dates=True,  # !important
     )
 
-    answ = " WHERE (created_at >= '2020-01-01' AND created_at < '2020-02-01')" \
-           " OR (updated_at >= '2020-01-01' AND updated_at < '2020-02-01')"
+    answ = " WHERE (created_at >= :start_datetime AND created_at < :end_datetime)" \
+           " OR (updated_at >= :start_datetime AND updated_at < :end_datetime)"
     assert where_clause == answ
+    assert params == {'start_datetime': '2020-01-01', 'end_datetime': '2020-02-01'}
+
+
+def test_ids_query_unions_timestamp_fields():
+    query = _ids_query('customers', 'id', ('created_at', 'updated_at'), True, True, 'UNION')
+    branches = [branch.split() for branch in query.split(' UNION ')]
+    assert branches == [
+        "SELECT id AS id FROM customers WHERE (created_at >= :start_datetime AND created_at < :end_datetime)".split(),
+        "SELECT id AS id FROM customers WHERE (updated_at >= :start_datetime AND updated_at < :end_datetime)".split(),
+    ]
+
+
+def _sqlite_client(path, ids):
+    engine = create_engine(f'sqlite:///{path}')
+    engine.execute('CREATE TABLE customers (id INTEGER PRIMARY KEY, created_at TIMESTAMP)')
+    for id in ids:
+        created_at = datetime.datetime(2020, 1, 1) + datetime.timedelta(hours=id)
+        engine.execute('INSERT INTO customers VALUES (?, ?)', id, str(created_at))
+    return DataClient(engine)
+
+
+def _sqlite_pair(tmp_path, source_ids, target_ids):
+    source = _sqlite_client(tmp_path / 'source.db', source_ids)
+    target = _sqlite_client(tmp_path / 'target.db', target_ids)
+    return ELTDBPair('test', source, target)
+
+
+def test_find_orphans_sql(tmp_path):
+    pair = _sqlite_pair(tmp_path, source_ids=[1, 2, 3], target_ids=[1, 2, 3, 4, 5])
+
+    assert pair.find_orphans_sql('customers', 'id') == {4, 5}
+    assert pair.find_orphans_sql('customers', 'id') == pair.find_orphans('customers', 'id')
+    # the staging table is cleaned up afterwards
+    assert pair.target.engine.table_names() == ['customers']
+
+
+def test_find_orphans_in_time_range(tmp_path):
+    pair = _sqlite_pair(tmp_path, source_ids=[1, 2, 3], target_ids=[1, 2, 3, 4, 5])
+    time_range = dict(
+        start_datetime=datetime.datetime(2020, 1, 1),
+        end_datetime=datetime.datetime(2020, 2, 1),
+        timestamp_fields=['created_at'],
+    )
+
+    assert pair.find_orphans('customers', 'id', **time_range) == {4, 5}
+    assert pair.find_orphans_sql('customers', 'id', **time_range) == {4, 5}
+    assert pair.find_orphans('customers', 'id', check_counts=False, **time_range) == {4, 5}
+    assert pair.find_orphans('customers', 'id', **dict(time_range, start_datetime=datetime.datetime(2020, 1, 2))) == set()
+
+
+def test_find_orphans_with_bloom_filter(tmp_path, monkeypatch):
+    pair = _sqlite_pair(tmp_path, source_ids=range(1000), target_ids=range(1010))
+    calls = []
+    count, query_iter = pair.source.count, pair.source.query_iter
+    monkeypatch.setattr(pair.source, 'count', lambda *args, **kwargs: calls.append('count') or count(*args, **kwargs))
+    monkeypatch.setattr(pair.source, 'query_iter', lambda *args: calls.append('query_iter') or query_iter(*args))
+
+    orphans = pair.find_orphans('customers', 'id', use_bloom_filter=True, bloom_error_rate=1e-9)
+    assert orphans == set(range(1000, 1010))
+    # the filter is sized before the ids are streamed
+    assert calls == ['count', 'query_iter']
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    bloom.update(range(1000))
+    assert all(i in bloom for i in range(1000))
+    assert sum(i in bloom for i in range(1000, 11000)) < 300
+
+
+def test_remove_orphans_from_target(tmp_path):
+    pair = _sqlite_pair(tmp_path, source_ids=[1, 2, 3], target_ids=[1, 2, 3, 4, 5])
+
+    assert pair.remove_orphans_from_target('customers', 'id') == 2
+    assert pair.target.count('customers') == 3
+    assert pair.target.engine.table_names() == ['customers']
+
+
+def test_delete_ids_query_by_dialect():
+    query = _delete_ids_query(postgresql.dialect(), 'customers', 'id', UUID())
+    assert query.split() == "DELETE FROM customers WHERE id = ANY(CAST(:ids AS UUID[]))".split()
+    query = _delete_ids_query(SimpleNamespace(name='bigquery'), 'customers', 'id', Integer())
+    assert query.split() == "DELETE FROM customers WHERE id IN UNNEST(:ids)".split()
+
+
+def test_delete_from_target_in_batches_on_bigquery(tmp_path, monkeypatch):
+    pair = _sqlite_pair(tmp_path, source_ids=[], target_ids=[])
+    monkeypatch.setattr(pair.target.engine.dialect, 'name', 'bigquery')
+    monkeypatch.setattr(client_module, 'BIGQUERY_DELETE_BATCH_SIZE', 2)
+    batches = []
+    monkeypatch.setattr(pair.target, 'execute', lambda query, params: batches.append(params['ids']))
+
+    pair._delete_from_target('customers', 'id', [1, 2, 3, 4, 5])
+    assert batches == [[1, 2], [3, 4], [5]]
+
+
+def test_remove_orphans_from_target_with_binary_search_segments(tmp_path, monkeypatch):
+    pair = _sqlite_pair(tmp_path, source_ids=range(200), target_ids=range(210))
+    segments = []
+    running = []
+    lock = threading.Lock()
+
+    def remove_orphans_from_target(table_name, key_field, use_bloom_filter=False, source_id_blooms=None, **kwargs):
+        with lock:
+            segments.append((kwargs['start_datetime'], kwargs['end_datetime']))
+            running.append(None)
+            assert len(running) <= 2
+        try:
+            assert pair.target.count(table_name, **kwargs) < 5
+            return len(pair.find_orphans(table_name, key_field, **kwargs))
+        finally:
+            with lock:
+                running.pop()
+    monkeypatch.setattr(pair, 'remove_orphans_from_target', remove_orphans_from_target)
+
+    removed = pair.remove_orphans_from_target_with_binary_search(
+        'customers',
+        'id',
+        start_datetime=datetime.datetime(2020, 1, 1),
+        end_datetime=datetime.datetime(2020, 2, 1),
+        timestamp_fields=['created_at'],
+        thres=5,
+        min_segment_size=datetime.timedelta(hours=1),
+        max_workers=2,
+    )
+    assert removed == 10
+    segments.sort()
+    assert segments[0][0] == datetime.datetime(2020, 1, 1)
+    assert segments[-1][1] == datetime.datetime(2020, 2, 1)
+    assert all(previous[1] == next[0] for previous, next in zip(segments, segments[1:]))
+
+
+def test_remove_orphans_from_target_with_binary_search_over_whole_table(tmp_path):
+    # the time range is the MIN and MAX of created_at, up to (excluding) the last row
+    pair = _sqlite_pair(tmp_path, source_ids=[0, 1, 2, 3, 4, 9], target_ids=range(10))
+
+    removed = pair.remove_orphans_from_target_with_binary_search('customers', 'id', timestamp_fields=['created_at'])
+    assert removed == 4
+    assert pair.find_orphans('customers', 'id') == set()
+
+
+def test_remove_orphans_from_target_with_binary_search_without_histogram(tmp_path, monkeypatch):
+    pair = _sqlite_pair(tmp_path, source_ids=range(20), target_ids=range(30))
+    monkeypatch.delitem(SECONDS_SINCE_SQL, 'sqlite')
+    queries = []
+    for client in (pair.source, pair.target):
+        def query_scalar(query, params=None, client=client, query_scalar=client.query_scalar):
+            queries.append((client, query, tuple(sorted((params or {}).items()))))
+            return query_scalar(query, params)
+        monkeypatch.setattr(client, 'query_scalar', query_scalar)
+
+    removed = pair.remove_orphans_from_target_with_binary_search(
+        'customers',
+        'id',
+        start_datetime=datetime.datetime(2020, 1, 1),
+        end_datetime=datetime.datetime(2020, 1, 3),
+        timestamp_fields=['created_at'],
+        thres=5,
+        min_segment_size=datetime.timedelta(hours=1),
+    )
+    assert removed == 10
+    # segments don't count the ranges again that were counted to plan them
+    assert len(queries) == len(set(queries))
+    assert pair.target.count('customers') == 20
+
+
+def test_insert_rows_in_batches(tmp_path):
+    client = _sqlite_client(tmp_path / 'target.db', ids=[])
+    rows = [{'id': id, 'created_at': None} for id in range(2500)]
+
+    response = client.insert_rows(rows, table='customers')
+    assert response == 'Inserted 2500 rows into `customers` with 2 columns: id, created_at'
+    assert client.count('customers') == 2500
+
+
+class _CopyCursor:
+    def copy_expert(self, query, buffer):
+        self.query = query
+        self.content = buffer.getvalue()
+
+    def close(self):
+        pass
+
+
+def test_copy_from_csv_renders_values(tmp_path):
+    client = _sqlite_client(tmp_path / 'target.db', ids=[])
+    cursor = _CopyCursor()
+    connection = SimpleNamespace(connection=SimpleNamespace(cursor=lambda: cursor))
+    rows = [
+        {'id': 1, 'created_at': datetime.datetime(2020, 1, 1, 12, 30)},
+        {'id': 2, 'created_at': None},
+        {'id': 3, 'created_at': 'a, "quoted" value'},
+    ]
+
+    client._copy_from_csv(rows, client.get_table('customers'), connection)
+    assert cursor.query == "COPY customers (id, created_at) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    assert cursor.content.splitlines() == [
+        '1,2020-01-01 12:30:00',
+        '2,\\N',
+        '3,"a, ""quoted"" value"',
+    ]
+
+
+def test_bulk_load_inserts_values_unfit_for_copy(tmp_path, monkeypatch):
+    client = _sqlite_client(tmp_path / 'target.db', ids=[])
+    client.engine.execute('CREATE TABLE notes (id INTEGER PRIMARY KEY, note TEXT)')
+    monkeypatch.setattr(client.engine.dialect, 'name', 'postgresql')
+    monkeypatch.setattr(client, '_copy_from_csv', None)
+
+    with client.engine.begin() as connection:
+        # a real \N string would be read back as NULL from CSV
+        client._bulk_load([{'id': 1, 'note': '\\N'}], client.get_table('notes'), connection)
+    assert client.query_scalar('SELECT note FROM notes') == '\\N'
+
+
+class _BigQueryClient:
+    def get_table(self, table_id):
+        return SimpleNamespace(schema=[SchemaField('id', 'INTEGER'), SchemaField('created_at', 'DATETIME')])
+
+    def load_table_from_json(self, json_rows, table_id, job_config=None):
+        self.json_rows, self.table_id, self.job_config = json_rows, table_id, job_config
+        return SimpleNamespace(result=lambda: None)
+
+
+def test_load_table_from_json_renders_values(tmp_path, monkeypatch):
+    client = _sqlite_client(tmp_path / 'target.db', ids=[])
+    monkeypatch.setattr(client.engine.dialect, 'dataset_id', 'dataset', raising=False)
+    bigquery_client = _BigQueryClient()
+    connection = SimpleNamespace(connection=SimpleNamespace(_client=bigquery_client))
+    rows = [{
+        'id': 1,
+        'created_at': datetime.datetime(2020, 1, 1, 12, 30),
+        'record': {'tags': ['a', 'b'], 'day': datetime.date(2020, 1, 1)},
+        'blob': b'\x00\xff',
+        'price': Decimal('1.50'),
+    }]
+
+    client._load_table_from_json(rows, client.get_table('customers'), connection)
+    assert bigquery_client.table_id == 'dataset.customers'
+    assert bigquery_client.json_rows == [{
+        'id': 1,
+        'created_at': '2020-01-01T12:30:00',
+        'record': {'tags': ['a', 'b'], 'day': '2020-01-01'},
+        'blob': 'AP8=',
+        'price': '1.50',
+    }]
+    # the table's schema is used, rather than autodetecting one
+    assert [field.name for field in bigquery_client.job_config.schema] == ['id', 'created_at']
+    assert not bigquery_client.job_config.autodetect
+
+
+def test_table_reflection_is_cached(tmp_path):
+    client = _sqlite_client(tmp_path / 'target.db', ids=[])
+    client.table_name = 'customers'
+
+    assert client.table is client.table
+    client.engine.execute('ALTER TABLE customers ADD COLUMN name TEXT')
+    assert 'name' not in client.table.c
+    client.invalidate_table('customers')
+    assert 'name' in client.table.c
+
+
+def test_find_orphans_with_uuid_keys(tmp_path):
+    ids = [uuid.uuid4() for _ in range(5)]
+    clients = []
+    for name, table_ids in (('source', ids[:3]), ('target', ids)):
+        engine = create_engine(f'sqlite:///{tmp_path / name}.db')
+        engine.execute('CREATE TABLE customers (id TEXT PRIMARY KEY)')
+        for id in table_ids:
+            engine.execute('INSERT INTO customers VALUES (?)', str(id))
+        clients.append(DataClient(engine))
+    pair = ELTDBPair('test', *clients)
+
+    assert pair.find_orphans('customers', 'id') == {str(ids[3]), str(ids[4])}
+
+
+def test_collect_ids_beyond_int64():
+    ids = _collect_ids([{'id': 1}, {'id': 2}])
+    assert isinstance(ids, numpy.ndarray) and ids.tolist() == [1, 2]
+    # e.g. MySQL BIGINT UNSIGNED keys, also past the first batch
+    rows = [{'id': 1}, {'id': 2}, {'id': 3}, {'id': 2 ** 63}, {'id': 4}]
+    assert _collect_ids(rows, batch_size=2) == {1, 2, 3, 2 ** 63, 4}
+
+
+def test_find_orphans_through_federated_schema(tmp_path):
+    pair = _sqlite_pair(tmp_path, source_ids=[1, 2, 3], target_ids=[1, 2, 3, 4, 5])
+    # make the source tables visible to the target as source.<table>
+    event.listen(pair.target.engine, 'connect', lambda connection, _: connection.execute(
+        f"ATTACH DATABASE '{tmp_path / 'source.db'}' AS source"
+    ))
+    pair.federated_schema = 'source'
+    pair.source = None  # everything has to happen on the target
+
+    assert pair.find_orphans('customers', 'id') == {4, 5}
+    assert pair.find_orphans(
+        'customers',
+        'id',
+        start_datetime=datetime.datetime(2020, 1, 1, 4),
+        end_datetime=datetime.datetime(2020, 2, 1),
+        timestamp_fields=['created_at'],
+    ) == {4, 5}
+    # counts are compared on the target as well
+    assert pair.compare_counts('customers') == 2
+    assert pair.find_orphans(
+        'customers',
+        'id',
+        start_datetime=datetime.datetime(2020, 1, 1),
+        end_datetime=datetime.datetime(2020, 1, 1, 4),
+        timestamp_fields=['created_at'],
+    ) == set()
+
+
+def test_find_orphans_with_daily_bloom_filters(tmp_path):
+    pair = _sqlite_pair(tmp_path, source_ids=range(100), target_ids=range(110))
+    # id 105 still exists in the source, just outside of the time range
+    pair.source.engine.execute("INSERT INTO customers VALUES (105, '2019-01-01 00:00:00')")
+    # id 5 moved to another day in the source
+    pair.source.engine.execute("UPDATE customers SET created_at = '2020-01-20 00:00:00' WHERE id = 5")
+    time_range = dict(
+        start_datetime=datetime.datetime(2020, 1, 1),
+        end_datetime=datetime.datetime(2020, 2, 1),
+        timestamp_fields=['created_at'],
+    )
+
+    source_id_blooms = {}
+    orphans = pair.find_orphans(
+        'customers',
+        'id',
+        use_bloom_filter=True,
+        bloom_error_rate=1e-9,
+        source_id_blooms=source_id_blooms,
+        **time_range,
+    )
+    assert orphans == set(range(100, 110)) - {105}
+    assert len(source_id_blooms) == 31
+
+    removed = pair.remove_orphans_from_target_with_binary_search('customers', 'id', use_bloom_filter=True, **time_range)
+    assert removed == 9
+    # the filters only live for one run, so deletions in the source are seen by the next one
+    pair.source.engine.execute("DELETE FROM customers WHERE id = 3")
+    removed = pair.remove_orphans_from_target_with_binary_search('customers', 'id', use_bloom_filter=True, **time_range)
+    assert removed == 1
@@ -27,6 +27,7 @@ setup(
     keywords='SQLAlchemy GCP Google BigQuery SQL ETL RDBMS',
     packages=find_packages(),
     install_requires=['SQLAlchemy',
+                      'numpy',
                       'PyBigQuery',
                       'PyMySQL',
                       'psycopg2',